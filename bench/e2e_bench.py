@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from aiohttp import ClientSession, web  # noqa: E402
+
+from fakes import FakeProviders, FakeSender, Trajectory  # noqa: E402
+
+# Offline end-to-end benchmark: drives server.py (through the aiohttp app in
+# serve.py) with bursts of calls against local fake GMGN/GeckoTerminal
+# servers and a fake Telegram sender, then reports
+#   - ingest -> first alert latency (POST sent -> message leaves the sender)
+#   - drop -> alert latency (drop visible at the provider -> message leaves)
+#   - provider polls per second and peak RSS
+# Each watch count runs in a fresh subprocess so state and peak memory don't
+# leak between runs.
+#
+#   python bench/e2e_bench.py                          # 10, 100, 1000 watches
+#   python bench/e2e_bench.py --watches 100 --gmgn-error-rate 0.2
+#   python bench/e2e_bench.py --watches 100 --gmgn-stall-rate 0.05   # hedging
+#   python bench/e2e_bench.py --max-p99-ms 500         # exit 1 on regression
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    return {f'p{pct}': percentile(values, pct) for pct in (50, 95, 99)}
+
+
+def contract_id(rng):
+    return ''.join(rng.choice('123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz') for _ in range(44))
+
+
+def script_calls(args, providers):
+    # The calls to post, with each contract's market-cap trajectory scripted
+    # on the fake providers: drop_ratio of them drop 65% partway through the
+    # watch window, the rest stay flat.
+    rng = random.Random(args.seed)
+    calls = []
+    drops = set()
+    for _ in range(args.watches):
+        key = contract_id(rng)
+        market_cap = rng.uniform(20_000, 200_000)
+        if rng.random() < args.drop_ratio:
+            drops.add(key)
+            at = rng.uniform(0.2, 0.8) * args.watch_timeout
+            providers.script(key, Trajectory.drop(market_cap, at))
+        else:
+            providers.script(key, Trajectory.flat(market_cap))
+        calls.append({'contractKey': key, 'marketCap': f'${market_cap / 1000:.1f}k'})
+    return calls, drops
+
+
+async def drive(args, server, serve, providers, sender, calls, drops):
+    runner = web.AppRunner(serve.make_app(server), access_log=None)
+    await runner.setup()  # runs server's startup hooks
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/save_contracts/batch'
+
+    batches = [calls[i:i + args.batch_size] for i in range(0, len(calls), args.batch_size)]
+    ingested_at = {}
+    statuses = {}
+    started = time.monotonic()
+
+    async with ClientSession() as session:
+        async def post(index, batch):
+            await asyncio.sleep(index * args.burst_seconds / len(batches))
+            sent_at = time.monotonic()
+            for call in batch:
+                ingested_at[call['contractKey']] = sent_at
+            async with session.post(url, json={'source': 'bench', 'calls': batch}) as response:
+                body = await response.json()
+            for result in body.get('results', []):
+                statuses[result.get('contractKey')] = result['status']
+
+        await asyncio.gather(*(post(i, batch) for i, batch in enumerate(batches)))
+
+    deadline = time.monotonic() + args.burst_seconds + args.watch_timeout + args.grace
+    while server.scheduler.watches and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    unfinished = len(server.scheduler.watches)
+    await runner.cleanup()  # runs server's shutdown hooks
+    providers.stop()
+
+    first_alert = []
+    drop_alert = []
+    for key, sent in sender.sent.items():
+        first_alert.append(sent[0] - ingested_at[key])
+        visible = providers.drop_visible_at(key)
+        if key in drops and len(sent) > 1 and visible is not None:
+            drop_alert.append(sent[1] - visible)
+
+    return {
+        'watches': args.watches,
+        'accepted': sum(status == 'accepted' for status in statuses.values()),
+        'rejected': sum(status == 'rejected' for status in statuses.values()),
+        'unfinished': unfinished,
+        'alerts': sum(len(sent) for sent in sender.sent.values()),
+        'drops_scripted': len(drops),
+        'drops_alerted': len(drop_alert),
+        'elapsed_s': elapsed,
+        'polls_per_s': sum(providers.requests.values()) / elapsed,
+        'provider_requests': providers.requests,
+        'provider_errors': providers.errors,
+        'ingest_to_alert_ms': {k: v and v * 1000 for k, v in summarize(first_alert).items()},
+        'drop_to_alert_ms': {k: v and v * 1000 for k, v in summarize(drop_alert).items()},
+    }
+
+
+def run_child(args):
+    # One benchmark run in this process: fake providers, then server.py bound
+    # to our loop with the fake sender swapped in.
+    import runtime
+
+    os.chdir(tempfile.mkdtemp(prefix='e2e-bench-'))
+    providers = FakeProviders(
+        gmgn={'latency': args.provider_latency, 'jitter': args.provider_latency / 2, 'error_rate': args.gmgn_error_rate,
+              'stall_rate': args.gmgn_stall_rate},
+        geckoterminal={'latency': args.provider_latency * 2, 'jitter': args.provider_latency, 'error_rate': args.gecko_error_rate},
+        seed=args.seed,
+    )
+    calls, drops = script_calls(args, providers)
+    gmgn_url, gecko_url = providers.start()
+    os.environ.update({
+        'CONTRACTS_DB': os.path.join(os.getcwd(), 'contracts.db'),
+        'GMGN_URL': gmgn_url,
+        'GECKOTERMINAL_URL': gecko_url,
+        'WATCH_TIMEOUT': str(args.watch_timeout),
+        'POLL_INTERVAL_GMGN': str(args.poll_interval),
+        'POLL_INTERVAL_GECKOTERMINAL': str(args.poll_interval * 2.5),
+        'MAX_CONCURRENT_POLLS': str(args.concurrency),
+        'QUOTE_TTL': str(args.poll_interval / 2),
+        'DRAIN_TIMEOUT': '0',
+        # The Telegram client is built at import but never started; the fake
+        # sender replaces it.
+        'API_ID': '1',
+        'API_HASH': 'offline-bench',
+    })
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runtime.bind(loop)
+    import server
+    import serve
+
+    sender = FakeSender(send_latency=args.send_latency)
+    server.sender = sender
+    try:
+        result = loop.run_until_complete(drive(args, server, serve, providers, sender, calls, drops))
+    finally:
+        providers.stop()
+    result['peak_rss_mib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def child_argv(args, watches, result_file):
+    argv = [sys.executable, os.path.abspath(__file__), '--child', '--result-file', result_file, '--watches', str(watches)]
+    for name in ('burst_seconds', 'batch_size', 'drop_ratio', 'watch_timeout', 'poll_interval', 'concurrency',
+                 'provider_latency', 'gmgn_error_rate', 'gmgn_stall_rate', 'gecko_error_rate', 'send_latency', 'grace', 'seed'):
+        argv += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+    return argv
+
+
+def fmt(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline ingest-to-alert latency and load benchmark.')
+    parser.add_argument('--watches', default='10,100,1000', help='comma-separated watch counts, one run each')
+    parser.add_argument('--burst-seconds', type=float, default=1.0, help='spread each burst of calls over this long')
+    parser.add_argument('--batch-size', type=int, default=50, help='calls per POST, like the extractors')
+    parser.add_argument('--drop-ratio', type=float, default=0.5, help='share of contracts scripted to drop 65%%')
+    parser.add_argument('--watch-timeout', type=float, default=3.0)
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='GMGN poll interval; GeckoTerminal is 2.5x')
+    parser.add_argument('--concurrency', type=int, default=50, help='MAX_CONCURRENT_POLLS')
+    parser.add_argument('--provider-latency', type=float, default=0.02, help='GMGN latency in seconds; GeckoTerminal is 2x')
+    parser.add_argument('--gmgn-error-rate', type=float, default=0.02)
+    parser.add_argument('--gmgn-stall-rate', type=float, default=0.0, help='share of GMGN requests that hang for 30s')
+    parser.add_argument('--gecko-error-rate', type=float, default=0.01)
+    parser.add_argument('--send-latency', type=float, default=0.005, help='simulated Telegram send time')
+    parser.add_argument('--grace', type=float, default=30.0, help='extra seconds to wait for watches to finish')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-p99-ms', type=float, help='exit 1 if ingest-to-alert p99 exceeds this')
+    parser.add_argument('--json', help='write all results to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the server's own output")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.watches = int(args.watches)
+        run_child(args)
+        return 0
+
+    results = []
+    failures = []
+    for watches in [int(n) for n in args.watches.split(',') if n]:
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        output = None if args.verbose else subprocess.DEVNULL
+        code = subprocess.call(child_argv(args, watches, result_file), stdout=output)
+        if code != 0:
+            failures.append(f"{watches} watches: benchmark run exited with {code}")
+            continue
+        with open(result_file) as f:
+            results.append(json.load(f))
+        os.unlink(result_file)
+
+    print(f"{'watches':>7} {'alerts':>6} {'drops':>9} {'rej':>4} {'polls/s':>8} "
+          f"{'ingest p50/p95/p99 ms':>24} {'drop p50/p95/p99 ms':>24} {'RSS MiB':>8}")
+    for r in results:
+        ingest = r['ingest_to_alert_ms']
+        drop = r['drop_to_alert_ms']
+        print(f"{r['watches']:>7} {r['alerts']:>6} {r['drops_alerted']:>4}/{r['drops_scripted']:<4} {r['rejected']:>4} "
+              f"{r['polls_per_s']:>8.0f} {fmt(ingest['p50']):>8}/{fmt(ingest['p95'])}/{fmt(ingest['p99']):<8} "
+              f"{fmt(drop['p50']):>8}/{fmt(drop['p95'])}/{fmt(drop['p99']):<8} {r['peak_rss_mib']:>8.0f}")
+        if not r['alerts']:
+            failures.append(f"{r['watches']} watches: no alerts were sent")
+        if r['unfinished']:
+            failures.append(f"{r['watches']} watches: {r['unfinished']} still running at the deadline")
+        p99 = ingest['p99']
+        if args.max_p99_ms is not None and p99 is not None and p99 > args.max_p99_ms:
+            failures.append(f"{r['watches']} watches: ingest-to-alert p99 {p99:.1f}ms > {args.max_p99_ms}ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
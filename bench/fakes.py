@@ -0,0 +1,215 @@
+import asyncio
+import bisect
+import multiprocessing
+import os
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+# Local stand-ins for GMGN, GeckoTerminal and Telegram, used by e2e_bench.py.
+# The provider fakes serve pages built from the fixtures in bench/fixtures,
+# so the server's extractors do the same parsing work as against the real
+# sites.
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def _split_fixture(name, marker):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        html = f.read()
+    before, after = html.split(marker, 1)
+    return before, after
+
+
+class Trajectory:
+    # Scripted market cap: a step function of seconds since the first time
+    # any provider was asked about the contract.
+
+    def __init__(self, points):
+        self.points = sorted(points)
+        self._times = [t for t, _ in self.points]
+
+    def value(self, elapsed):
+        index = bisect.bisect_right(self._times, elapsed) - 1
+        return self.points[max(index, 0)][1]
+
+    @classmethod
+    def flat(cls, market_cap):
+        return cls([(0, market_cap)])
+
+    @classmethod
+    def drop(cls, market_cap, at, factor=0.35):
+        # factor=0.35 is a 65% drop, past the server's default 60% threshold.
+        return cls([(0, market_cap), (at, market_cap * factor)])
+
+
+class FakeProvider:
+    # stall_rate is the share of requests that hang for stall seconds before
+    # answering, like a provider having a bad moment.
+
+    def __init__(self, name, render, latency=0.02, jitter=0.01, error_rate=0.0, stall_rate=0.0, stall=30.0, seed=None):
+        self.name = name
+        self.render = render
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+
+
+class FakeProviders:
+    # Fake GMGN and GeckoTerminal servers. They run in their own process, so
+    # rendering pages doesn't compete for the GIL with the server under test.
+    # Script every contract's trajectory before start(); after stop(),
+    # requests/errors/first_seen hold what the fakes saw. first_seen uses
+    # time.monotonic(), which is comparable across processes on Linux.
+
+    def __init__(self, gmgn=None, geckoterminal=None, seed=0):
+        self.config = {'gmgn': gmgn or {}, 'geckoterminal': geckoterminal or {}, 'seed': seed}
+        self.trajectories = {}
+        self.first_seen = {}
+        self.requests = {'gmgn': 0, 'geckoterminal': 0}
+        self.errors = {'gmgn': 0, 'geckoterminal': 0}
+        self._process = None
+        self._conn = None
+
+    def script(self, contract_id, trajectory):
+        self.trajectories[contract_id] = trajectory
+
+    def drop_visible_at(self, contract_id):
+        # Monotonic time the last step of the contract's trajectory became
+        # visible, or None if it was never requested or has a single step.
+        trajectory = self.trajectories.get(contract_id)
+        first_seen = self.first_seen.get(contract_id)
+        if trajectory is None or first_seen is None or len(trajectory.points) < 2:
+            return None
+        return first_seen + trajectory.points[-1][0]
+
+    def start(self):
+        # Returns (gmgn_url, geckoterminal_url).
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve_providers,
+            args=(self.config, self.trajectories, child_conn),
+            name='fake-providers',
+            daemon=True,
+        )
+        self._process.start()
+        if not self._conn.poll(10):
+            raise RuntimeError('fake providers did not start')
+        base = f'http://127.0.0.1:{self._conn.recv()}'
+        return base, base
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._conn.send('stop')
+        stats = self._conn.recv()
+        self._process.join()
+        self._process = None
+        self.first_seen = stats['first_seen']
+        self.requests = stats['requests']
+        self.errors = stats['errors']
+
+
+def _serve_providers(config, trajectories, conn):
+    gmgn_page = _split_fixture('gmgn_plain.html', '"market_cap":48213.57')
+    gecko_page = _split_fixture('geckoterminal_k.html', '$40.7K')
+    providers = {
+        'gmgn': FakeProvider(
+            'gmgn',
+            lambda market_cap: f'{gmgn_page[0]}"market_cap":{market_cap}{gmgn_page[1]}',
+            seed=config['seed'],
+            **config['gmgn'],
+        ),
+        'geckoterminal': FakeProvider(
+            'geckoterminal',
+            lambda market_cap: f'{gecko_page[0]}${market_cap:,.0f}{gecko_page[1]}',
+            seed=config['seed'] + 1,
+            **config['geckoterminal'],
+        ),
+    }
+    first_seen = {}
+
+    def handler(provider):
+        async def handle(request):
+            contract_id = request.match_info['contract_id']
+            provider.requests += 1
+            now = time.monotonic()
+            started = first_seen.setdefault(contract_id, now)
+            delay = provider.latency + provider.random.uniform(-provider.jitter, provider.jitter)
+            if provider.random.random() < provider.stall_rate:
+                delay = provider.stall
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if provider.random.random() < provider.error_rate:
+                provider.errors += 1
+                return web.Response(status=500, text='upstream error')
+            trajectory = trajectories.get(contract_id)
+            if trajectory is None:
+                return web.Response(status=404, text='unknown token')
+            market_cap = trajectory.value(now - started)
+            return web.Response(text=provider.render(market_cap), content_type='text/html')
+        return handle
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get('/sol/token/{contract_id}', handler(providers['gmgn']))
+        app.router.add_get('/solana/pools/{contract_id}', handler(providers['geckoterminal']))
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        conn.send(site._server.sockets[0].getsockname()[1])
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        await runner.cleanup()
+        conn.send({
+            'first_seen': first_seen,
+            'requests': {name: p.requests for name, p in providers.items()},
+            'errors': {name: p.errors for name, p in providers.items()},
+        })
+
+    asyncio.run(serve())
+
+
+class FakeSender:
+    # Drop-in for sender.TelegramSender: records when each message would have
+    # left instead of talking to Telegram. send_latency simulates the round
+    # trip of one send_message call; messages still go out one at a time.
+
+    def __init__(self, send_latency=0.0):
+        self.send_latency = send_latency
+        self.queue = asyncio.Queue()
+        self.sent = defaultdict(list)  # message -> [monotonic send times]
+        self._worker = None
+
+    async def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            await self.queue.join()
+            self._worker.cancel()
+            self._worker = None
+
+    def enqueue(self, chat_id, message):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((message, time.monotonic(), future))
+        return future
+
+    async def _run(self):
+        while True:
+            message, enqueued_at, future = await self.queue.get()
+            if self.send_latency:
+                await asyncio.sleep(self.send_latency)
+            now = time.monotonic()
+            self.sent[message].append(now)
+            if not future.done():
+                future.set_result(now - enqueued_at)
+            self.queue.task_done()
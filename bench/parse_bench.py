@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import extract_geckoterminal_market_cap, extract_gmgn_market_cap  # noqa: E402
+
+# Micro-benchmark for the market-cap extractors. For each saved page in
+# bench/fixtures it checks the extracted value against expected.json, then
+# reports the time per page and the peak memory allocated while parsing it.
+#
+#   python bench/parse_bench.py              # fast-path extractors only
+#   python bench/parse_bench.py --legacy     # also time the old find()/BeautifulSoup code
+#   python bench/parse_bench.py --max-us 200 # exit 1 if any page is slower
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def legacy_parse_market_cap(market_cap_str):
+    # The parser as it was in server.py before extract.py, so --legacy times
+    # (and fails on) exactly what the old code did.
+    market_cap_str = market_cap_str.lower()
+    if 'k' in market_cap_str:
+        value = float(market_cap_str.replace('$', '').replace(',', '').replace('k', '')) * 1000
+    elif 'm' in market_cap_str:
+        value = float(market_cap_str.replace('$', '').replace(',', '').replace('m', '')) * 1000000
+    else:
+        value = float(market_cap_str.replace('$', '').replace(',', ''))
+    return round(value, 1)
+
+
+def legacy_gmgn(html):
+    start_index = html.find('"market_cap":') + len('"market_cap":')
+    end_index = html.find(',', start_index)
+    return legacy_parse_market_cap(html[start_index:end_index].strip())
+
+
+def legacy_geckoterminal(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    market_cap_th = soup.find('th', string='Market Cap')
+    if market_cap_th:
+        market_cap_td = market_cap_th.find_next('td', class_='number-1')
+        if market_cap_td:
+            market_cap_span = market_cap_td.find('span')
+            if market_cap_span:
+                return legacy_parse_market_cap(market_cap_span.text.strip())
+    return None
+
+
+EXTRACTORS = {
+    'gmgn': extract_gmgn_market_cap,
+    'geckoterminal': extract_geckoterminal_market_cap,
+}
+LEGACY = {
+    'gmgn': legacy_gmgn,
+    'geckoterminal': legacy_geckoterminal,
+}
+
+
+def _ignore_errors(fn):
+    def call(html):
+        try:
+            return fn(html)
+        except Exception:
+            return None
+    return call
+
+
+def time_per_call(fn, html, repeat):
+    timer = timeit.Timer(lambda: fn(html))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def peak_allocated(fn, html):
+    tracemalloc.start()
+    try:
+        fn(html)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def run(legacy, repeat):
+    with open(os.path.join(FIXTURES, 'expected.json')) as f:
+        expected = json.load(f)
+
+    rows = []
+    failures = []
+    for name in sorted(expected):
+        provider = name.split('_', 1)[0]
+        with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+            html = f.read()
+
+        variants = [('fast', EXTRACTORS[provider])]
+        if legacy:
+            variants.append(('legacy', LEGACY[provider]))
+        for variant, fn in variants:
+            try:
+                value = fn(html)
+            except Exception as e:
+                # The legacy parser raises on null and exponent values; time
+                # how long it takes to get there.
+                value = f'error: {e}'
+                fn = _ignore_errors(fn)
+            if variant == 'fast' and value != expected[name]:
+                failures.append(f"{name}: expected {expected[name]!r}, got {value!r}")
+            rows.append({
+                'page': name,
+                'variant': variant,
+                'bytes': len(html),
+                'value': value,
+                'us': time_per_call(fn, html, repeat) * 1e6,
+                'peak_kib': peak_allocated(fn, html) / 1024,
+            })
+    return rows, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the market-cap extractors against saved pages.')
+    parser.add_argument('--legacy', action='store_true', help='also time the pre-extract.py parsing code (needs beautifulsoup4)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-us', type=float, help='fail if a fast-path page takes longer than this')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    rows, failures = run(args.legacy, args.repeat)
+
+    print(f"{'page':<28} {'variant':<7} {'KiB':>6} {'us/page':>10} {'peak KiB':>9}  value")
+    for row in rows:
+        print(f"{row['page']:<28} {row['variant']:<7} {row['bytes'] / 1024:>6.0f} {row['us']:>10.1f} {row['peak_kib']:>9.1f}  {row['value']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+    if args.max_us is not None:
+        for row in rows:
+            if row['variant'] == 'fast' and row['us'] > args.max_us:
+                failures.append(f"{row['page']}: {row['us']:.1f}us > {args.max_us}us")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+import json
+import re
+from html import unescape
+
+# Market-cap extraction for the provider pages. This runs on every poll of
+# every watch, so nothing here builds a DOM: each extractor jumps to the one
+# field it needs and stops.
+
+_SUFFIXES = {'k': 1e3, 'm': 1e6, 'b': 1e9}
+_MARKET_CAP_RE = re.compile(r'\$?\s*((?=\.?\d)[\d,]*\.?\d*(?:e[+-]?\d+)?)\s*([kmb])?', re.IGNORECASE)
+
+_json_decoder = json.JSONDecoder()
+_GMGN_STATE = 'id="__NEXT_DATA__"'
+_GMGN_FIELD_RE = re.compile(r'"market_cap"\s*:\s*')
+
+_GECKO_HEADER_RE = re.compile(r'<th\b[^>]*>\s*Market Cap\s*</th>')
+_GECKO_CELL_RE = re.compile(r'<td\b[^>]*\bclass="(?:[^"]*\s)?number-1(?:\s[^"]*)?"[^>]*>')
+_GECKO_SPAN_RE = re.compile(r'<span\b[^>]*>([^<]*)</span>')
+
+
+def parse_market_cap(value):
+    # Accepts what the extractors and providers hand us: '$40.7k', '1,234',
+    # '1.2M', '3.4B', JSON numbers (including 1.2e+06) and null. Returns None
+    # for null/empty, raises ValueError for anything else it can't read.
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(float(value), 1)
+    if not isinstance(value, str):
+        raise ValueError(f"could not parse market cap {value!r}")
+
+    text = value.strip().strip('"').strip()
+    if not text or text.lower() in ('null', 'none', 'nan', '-'):
+        return None
+    match = _MARKET_CAP_RE.fullmatch(text)
+    if match is None:
+        raise ValueError(f"could not parse market cap {value!r}")
+    number, suffix = match.groups()
+    result = float(number.replace(',', ''))
+    if suffix:
+        result *= _SUFFIXES[suffix.lower()]
+    return round(result, 1)
+
+
+def extract_gmgn_market_cap(html):
+    # GMGN is a Next.js page: the token state is a JSON blob in the
+    # __NEXT_DATA__ script. Find the field inside it and decode just that
+    # one value instead of the whole blob.
+    start = html.find(_GMGN_STATE)
+    match = _GMGN_FIELD_RE.search(html, start if start != -1 else 0)
+    if match is None and start != -1:
+        match = _GMGN_FIELD_RE.search(html)
+    if match is None:
+        return None
+    try:
+        value, _ = _json_decoder.raw_decode(html, match.end())
+    except json.JSONDecodeError as e:
+        raise ValueError(f"malformed market_cap in GMGN page: {e}") from None
+    return parse_market_cap(value)
+
+
+def extract_geckoterminal_market_cap(html):
+    # Scan forward to the 'Market Cap' row header, then take the first
+    # number-1 cell after it and the first span inside that cell. Stops at
+    # the first match.
+    header = _GECKO_HEADER_RE.search(html)
+    if header is None:
+        return None
+    cell = _GECKO_CELL_RE.search(html, header.end())
+    if cell is None:
+        return None
+    cell_end = html.find('</td>', cell.end())
+    span = _GECKO_SPAN_RE.search(html, cell.end(), cell_end if cell_end != -1 else len(html))
+    if span is None:
+        return None
+    return parse_market_cap(unescape(span.group(1)))
@@ -4,22 +4,48 @@
     const contractRegex = /https:\/\/solscan\.io\/token\/([a-zA-Z0-9]+)/;
     const marketCap = "$40.7k"; // Hardcoded market cap value
 
-    async function sendContractPairsToServer(pair) {
+    const source = 'finderTrending';
+    const pendingPairs = [];
+    let flushTimer = null;
+
+    // Calls are queued and flushed to the batch endpoint on the next tick, so
+    // a page load or rescan that finds many contracts in one pass sends one
+    // request, not one each, without delaying a single live call.
+    function sendContractPairsToServer(pair) {
+        pendingPairs.push(pair);
+        if (pendingPairs.length >= 50) {
+            flushContractPairs();
+        } else if (!flushTimer) {
+            flushTimer = setTimeout(flushContractPairs, 0);
+        }
+    }
+
+    async function flushContractPairs() {
+        clearTimeout(flushTimer);
+        flushTimer = null;
+        if (pendingPairs.length === 0) {
+            return;
+        }
+        const calls = pendingPairs.splice(0, pendingPairs.length);
         try {
-            const response = await fetch('http://127.0.0.1:5001/save_contracts', {
+            const response = await fetch('http://127.0.0.1:5001/save_contracts/batch', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify(pair),
+                body: JSON.stringify({ source, calls }),
+                keepalive: true,
             });
             const result = await response.json();
             console.log(`Server response: ${JSON.stringify(result)}`);
         } catch (error) {
-            console.error('Error sending contract pair to server:', error);
+            console.error('Error sending contract pairs to server:', error);
         }
     }
 
+    // Don't lose queued calls when the page reloads itself.
+    window.addEventListener('pagehide', flushContractPairs);
+
     function extractDataFromElement(element) {
         const links = element.querySelectorAll('a[href*="https://solscan.io/token/"]');
         links.forEach(link => {
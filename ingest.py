@@ -0,0 +1,104 @@
+import json
+
+from extract import parse_market_cap
+
+# Every extractor names its fields a little differently; this is the one
+# place that maps them onto contractKey / marketCap / source.
+CONTRACT_KEY_FIELDS = ('contractKey', 'contract_key', 'tokenAddress', 'token_address', 'contract', 'address')
+MARKET_CAP_FIELDS = ('marketCap', 'market_cap', 'mc')
+SOURCE_FIELDS = ('source', 'channel')
+
+MAX_BATCH_SIZE = 1000
+
+
+def _first(item, fields):
+    for name in fields:
+        value = item.get(name)
+        if value is not None and value != '':
+            return value
+    return None
+
+
+def normalize_call(item, default_source=None):
+    # Returns {'contractKey', 'marketCap', 'source'} or raises ValueError.
+    if isinstance(item, ValueError):
+        raise item  # an NDJSON line that wasn't valid JSON
+    if not isinstance(item, dict):
+        raise ValueError('call must be a JSON object')
+    contract_key = _first(item, CONTRACT_KEY_FIELDS)
+    if not isinstance(contract_key, str) or not contract_key.strip():
+        raise ValueError('missing contract key')
+    market_cap = parse_market_cap(_first(item, MARKET_CAP_FIELDS))
+    if market_cap is None:
+        raise ValueError('missing market cap')
+    source = _first(item, SOURCE_FIELDS) or default_source
+    return {
+        'contractKey': contract_key.strip(),
+        'marketCap': market_cap,
+        'source': str(source) if source is not None else None,
+    }
+
+
+def parse_batch(body, content_type=''):
+    # Accepts a JSON array of calls, an object {"source": ..., "calls": [...]},
+    # or NDJSON (one call per line). Returns (default_source, items). An
+    # NDJSON line that isn't JSON becomes a ValueError item, reported as
+    # invalid on its own so the rest of the stream is still ingested.
+    if 'ndjson' in (content_type or ''):
+        items = []
+        for line_number, line in enumerate(body.splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                items.append(ValueError(f"line {line_number}: {e}"))
+        source = None
+    else:
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError as e:
+            raise ValueError(str(e)) from None
+        if isinstance(data, list):
+            items, source = data, None
+        elif isinstance(data, dict) and isinstance(data.get('calls'), list):
+            items, source = data['calls'], _first(data, SOURCE_FIELDS)
+        else:
+            raise ValueError('expected a list of calls or {"calls": [...]}')
+
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(f"batch too large ({len(items)} > {MAX_BATCH_SIZE})")
+    return source, items
+
+
+def ingest_calls(items, store, default_source=None):
+    # One pass over the batch: normalize each call, drop repeats within the
+    # batch and contracts already alerted on, then record the rest in a
+    # single store write. Returns (results, accepted) where results has one
+    # entry per input item and accepted is the list of calls to watch.
+    results = []
+    accepted = []
+    seen = set()
+    for item in items:
+        try:
+            call = normalize_call(item, default_source)
+        except ValueError as e:
+            results.append({'status': 'invalid', 'error': str(e)})
+            continue
+
+        contract_key = call['contractKey']
+        result = {'contractKey': contract_key, 'source': call['source']}
+        if contract_key in seen:
+            result['status'] = 'duplicate'
+        elif store.is_sent(contract_key):
+            result['status'] = 'sent'
+        else:
+            result['status'] = 'accepted'
+            accepted.append(call)
+        seen.add(contract_key)
+        results.append(result)
+
+    if accepted:
+        store.add_contracts([(call['contractKey'], call['marketCap']) for call in accepted])
+    return results, accepted
@@ -0,0 +1,158 @@
+import json
+import os
+import time
+import uuid
+from bisect import bisect_left
+
+# In-process metrics for the call-to-alert pipeline, rendered in the
+# Prometheus text format at /metrics, plus structured per-contract trace
+# lines. Everything is observed from the runtime loop, so there is no
+# locking: an observation is a bisect and two additions.
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+TRACE = os.getenv('TRACE_LOG', '1') != '0'
+
+_metrics = []
+
+
+def _labels(labelnames, labelvalues, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for labelvalues, value in sorted(self.values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labelvalues)} {value}'
+
+
+class Gauge:
+    # Read when rendered: fn() returns a number, or a {labelvalues: number}
+    # dict for labelled gauges.
+    def __init__(self, name, help, fn, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        self.kind = kind
+        _metrics.append(self)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        value = self.fn()
+        if isinstance(value, dict):
+            for labelvalues, v in sorted(value.items()):
+                yield f'{self.name}{_labels(self.labelnames, labelvalues)} {v}'
+        else:
+            yield f'{self.name} {value}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labelvalues', 'start')
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.children = {}  # labelvalues -> [bucket counts..., +Inf count, sum]
+        _metrics.append(self)
+
+    def observe(self, value, *labelvalues):
+        child = self.children.get(labelvalues)
+        if child is None:
+            child = self.children[labelvalues] = [0] * (len(self.buckets) + 2)
+        child[bisect_left(self.buckets, value)] += 1
+        child[-1] += value
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def count(self, *labelvalues):
+        child = self.children.get(labelvalues)
+        return sum(child[:-1]) if child else 0
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        for labelvalues, child in sorted(self.children.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, child):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(self.labelnames, labelvalues, bound)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {child[-1]}'
+            yield f'{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}'
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def trace(event, contract_key, trace_id=None, **fields):
+    # One JSON line per pipeline event. Watch events carry the watch's trace
+    # id, assigned when the call is ingested, so a call can be followed from
+    # ingest to its last alert; quote fetches are shared between watches and
+    # carry only the contract. Disable with TRACE_LOG=0.
+    if not TRACE:
+        return
+    record = {'ts': round(time.time(), 6), 'event': event, 'contract': contract_key}
+    if trace_id is not None:
+        record['traceId'] = trace_id
+    record.update(fields)
+    print(json.dumps(record, separators=(',', ':')))
+
+
+# Pipeline stages
+INGEST_SECONDS = Histogram('ingest_seconds', 'Time to validate, dedupe, store and schedule one ingest request.', ('endpoint',))
+INGEST_CALLS = Counter('ingest_calls_total', 'Calls received, by ingest result.', ('status',))
+QUOTE_FETCH_SECONDS = Histogram('quote_fetch_seconds', 'Upstream quote fetch time including parsing, by provider and result (ok, empty, timeout, error, cancelled).', ('provider', 'result'))
+PARSE_SECONDS = Histogram('parse_seconds', 'Market-cap extraction time per page, by provider.', ('provider',))
+SEND_SECONDS = Histogram('send_seconds', 'Time from enqueueing a Telegram message to Telegram acknowledging it.')
+QUOTE_LOOKUPS = Counter('quote_upstream_lookups_total', 'Quote lookups that went upstream (cache misses).')
+QUOTE_FALLBACKS = Counter('quote_fallbacks_total', 'Times a provider returned nothing and the next one was tried.', ('from_provider', 'to_provider'))
+QUOTE_HEDGES = Counter('quote_hedges_total', 'Times a provider was slower than its hedge delay and the next one was asked as well.', ('from_provider', 'to_provider'))
+WATCH_OUTCOMES = Counter('watch_outcomes_total', 'Finished watches by outcome (dropped, timed_out, failed, unavailable, error, cancelled, shed).', ('outcome',))
+ALERTS = Counter('alerts_total', 'Alerts sent, by kind (call, drop).', ('kind',))
+FALLBACK_RATIO = Gauge('quote_fallback_ratio', 'Share of upstream lookups that fell back past the first provider.',
+                       lambda: QUOTE_FALLBACKS.total() / QUOTE_LOOKUPS.total() if QUOTE_LOOKUPS.total() else 0.0)
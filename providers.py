@@ -0,0 +1,310 @@
+import asyncio
+import time
+from collections import deque
+
+import metrics
+from watcher import RetryLater
+
+DEFAULT_TIMEOUT = 5.0  # per-request deadline, seconds
+SORT_EVERY = 0.5  # how stale latency percentiles may get, seconds
+
+_FAILED = object()  # what _call returns when the provider itself failed
+
+
+class ProviderError(Exception):
+    # Raised by a provider's fetch when the provider itself is failing (5xx,
+    # rate limited), as opposed to having no market cap for the token.
+    pass
+
+
+class NoProviderAvailable(RetryLater):
+    # Every provider's breaker is open; retry once the first one may close.
+    pass
+
+
+class ProvidersFailed(RetryLater):
+    # Every provider asked failed or timed out, so nobody actually said the
+    # token has no market cap; retry instead of treating it as no quote.
+    pass
+
+
+class Provider:
+    # One quote source, fetch(session, contract_id) -> market cap, or None
+    # if the source has no market cap for the token (e.g. not indexed yet).
+    # fetch raises when the source itself fails: network errors, 5xx,
+    # ProviderError. Only those failures and timeouts count against its
+    # health and breaker; fresh tokens missing from a healthy source don't.
+    #
+    # We also keep what we've seen of it recently: whether requests were
+    # answered, whether the answers had a quote, and how long the answered
+    # ones (or those that hit the deadline) took. Quick failures only count
+    # against health, and quick empty answers against the quote rate, so
+    # neither can make a provider look fast. A hedged request that lost the race and was
+    # cancelled counts as at least as slow as it got, so a provider that has
+    # slowed down stops looking fast too. Samples older than horizon
+    # seconds are forgotten, so a provider that recovered gets another look.
+    #
+    # Circuit breaker: after failure_threshold failures in a row the
+    # provider is skipped for reset_timeout seconds, then one probe request
+    # is let through; an answer closes the breaker, a failure opens it again.
+
+    def __init__(self, name, fetch, poll_interval, timeout=DEFAULT_TIMEOUT, window=100, horizon=60.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.fetch = fetch
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.horizon = horizon
+        self.latencies = deque(maxlen=window)  # (monotonic, seconds)
+        self.outcomes = deque(maxlen=window)  # (monotonic, answered)
+        self.quoted = deque(maxlen=window)  # (monotonic, had a quote), answered requests only
+        self._sorted = None  # latencies, sorted at most every SORT_EVERY seconds
+        self._sorted_at = 0.0
+        self.failures = 0  # in a row
+        self.opened_at = None
+        self.probing = False
+        self.requests = 0
+
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() >= self.opened_at + self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def available(self):
+        state = self.state()
+        return state == 'closed' or (state == 'half_open' and not self.probing)
+
+    def retry_in(self):
+        # Seconds until this provider may be available again.
+        state = self.state()
+        if state == 'open':
+            return self.opened_at + self.reset_timeout - time.monotonic()
+        if state == 'half_open' and self.probing:
+            return min(self.poll_interval, self.timeout)
+        return 0.0
+
+    def begin(self):
+        self.requests += 1
+        if self.state() == 'half_open':
+            self.probing = True
+
+    def record(self, ok, latency=None, quoted=True):
+        now = time.monotonic()
+        if latency is not None:
+            self.latencies.append((now, latency))
+        self.outcomes.append((now, ok))
+        if ok:
+            self.quoted.append((now, quoted))
+        if ok:
+            if self.opened_at is not None:
+                print(f"Quote provider {self.name} recovered, closing its circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+                print(f"Quote provider {self.name} failed {self.failures} times in a row, skipping it for {self.reset_timeout}s")
+                self.opened_at = time.monotonic()
+        self.probing = False
+
+    def record_cancelled(self, latency):
+        self.latencies.append((time.monotonic(), latency))
+        self.probing = False
+
+    def percentile(self, pct):
+        now = time.monotonic()
+        _expire(self.latencies, now - self.horizon)
+        if not self.latencies:
+            return None
+        if self._sorted is None or now - self._sorted_at > SORT_EVERY:
+            self._sorted = sorted(latency for _, latency in self.latencies)
+            self._sorted_at = now
+        return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * pct / 100))]
+
+    def health(self):
+        _expire(self.outcomes, time.monotonic() - self.horizon)
+        if not self.outcomes:
+            return 1.0
+        return sum(ok for _, ok in self.outcomes) / len(self.outcomes)
+
+    def quote_rate(self):
+        _expire(self.quoted, time.monotonic() - self.horizon)
+        if not self.quoted:
+            return 1.0
+        return sum(quoted for _, quoted in self.quoted) / len(self.quoted)
+
+    def score(self):
+        # Roughly the expected seconds to a quote: median latency inflated by
+        # the failure rate and by how often its answers have no quote. Lower
+        # is better. A provider with no latency samples yet scores 0, so it
+        # gets asked first and earns some; one that only fails is left to its
+        # breaker.
+        median = self.percentile(50)
+        if median is None:
+            return 0.0
+        return median / max(self.health() * self.quote_rate(), 0.01)
+
+    def stats(self):
+        return {
+            'state': self.state(),
+            'health': self.health(),
+            'quoteRate': self.quote_rate(),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'score': self.score(),
+            'requests': self.requests,
+            'pollInterval': self.poll_interval,
+        }
+
+
+class ProviderPool:
+    # Fetches a quote from the best provider available right now. Providers
+    # are ranked by score (ties keep the configured order) and any with an
+    # open breaker are skipped. The first one is the primary. If it hasn't
+    # answered within its hedge_percentile latency, the next one is asked as
+    # well and whichever quotes first wins; if it fails or has no quote, the
+    # next one is asked straight away. Every request is bounded by its
+    # provider's timeout, so a hung provider costs at most that long per
+    # poll. If every breaker is open, fetch raises NoProviderAvailable, and if
+    # every provider it asked failed, ProvidersFailed, rather than reporting
+    # no quote, so the watch waits instead of failing.
+
+    def __init__(self, providers, hedge_percentile=95, min_hedge_delay=0.05, default_hedge_delay=1.0):
+        self.providers = providers
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+
+    @property
+    def requests(self):
+        return sum(provider.requests for provider in self.providers)
+
+    def ranked(self):
+        order = {provider.name: i for i, provider in enumerate(self.providers)}
+        available = [provider for provider in self.providers if provider.available()]
+        return sorted(available, key=lambda provider: (provider.score(), order[provider.name]))
+
+    def primary(self):
+        ranked = self.ranked()
+        return ranked[0].name if ranked else None
+
+    def poll_intervals(self):
+        return {provider.name: provider.poll_interval for provider in self.providers}
+
+    def hedge_delay(self, provider):
+        latency = provider.percentile(self.hedge_percentile)
+        if latency is None:
+            latency = self.default_hedge_delay
+        return min(max(latency, self.min_hedge_delay), provider.timeout)
+
+    def stats(self):
+        primary = self.primary()
+        return {
+            provider.name: dict(provider.stats(), primary=provider.name == primary, hedgeDelay=self.hedge_delay(provider))
+            for provider in self.providers
+        }
+
+    def retry_in(self):
+        # Seconds until it's worth asking again: until the first breaker may
+        # close, or the poll interval of a provider that is still in rotation.
+        return max(0.0, min(provider.retry_in() or provider.poll_interval for provider in self.providers))
+
+    async def fetch(self, session, contract_id):
+        # Returns (market_cap, source); market_cap is None if a provider
+        # answered but none had a quote, with source the last one asked.
+        queue = self.ranked()
+        if not queue:
+            retry_in = self.retry_in()
+            raise NoProviderAvailable(retry_in, f"every quote provider is unavailable for {retry_in:.1f}s")
+        running = {}  # task -> (provider, started)
+        answered = False
+        source = None
+        latest = None  # task for the provider asked most recently
+        hedge_at = None
+        try:
+            while True:
+                if queue and latest not in running:
+                    # Nobody asked yet, or the latest provider failed: ask
+                    # the next one now rather than waiting out a hedge delay.
+                    if latest is not None:
+                        metrics.QUOTE_FALLBACKS.inc(source, queue[0].name)
+                    latest, hedge_at = self._start(queue.pop(0), session, contract_id, running)
+                    continue
+                if not running:
+                    if not answered:
+                        retry_in = self.retry_in()
+                        raise ProvidersFailed(retry_in, f"no quote provider answered, retrying in {retry_in:.1f}s")
+                    return None, source
+
+                now = time.perf_counter()
+                wake = min(started + provider.timeout for provider, started in running.values())
+                if queue:
+                    wake = min(wake, hedge_at)
+                done, _ = await asyncio.wait(running, timeout=max(0.0, wake - now), return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    provider, _ = running.pop(task)
+                    source = provider.name
+                    market_cap = task.result()
+                    if market_cap is _FAILED:
+                        continue
+                    answered = True
+                    if market_cap is not None:
+                        return market_cap, source
+                if done:
+                    continue
+
+                now = time.perf_counter()
+                for task, (provider, started) in list(running.items()):
+                    if now >= started + provider.timeout:
+                        # Past its deadline: give up on it, as a failure.
+                        del running[task]
+                        task.cancel()
+                        source = provider.name
+                        provider.record(False, now - started)
+                        metrics.QUOTE_FETCH_SECONDS.observe(now - started, provider.name, 'timeout')
+                        metrics.trace('quote.error', contract_id, provider=provider.name,
+                                      error=f"no answer within {provider.timeout}s")
+                if queue and latest in running and now >= hedge_at:
+                    metrics.QUOTE_HEDGES.inc(running[latest][0].name, queue[0].name)
+                    latest, hedge_at = self._start(queue.pop(0), session, contract_id, running)
+        finally:
+            now = time.perf_counter()
+            for task, (provider, started) in running.items():
+                task.cancel()
+                provider.record_cancelled(now - started)
+                metrics.QUOTE_FETCH_SECONDS.observe(now - started, provider.name, 'cancelled')
+
+    def _start(self, provider, session, contract_id, running):
+        # Returns the request's task and when to hedge it.
+        provider.begin()
+        task = asyncio.ensure_future(self._call(provider, session, contract_id))
+        started = time.perf_counter()
+        running[task] = (provider, started)
+        return task, started + self.hedge_delay(provider)
+
+    async def _call(self, provider, session, contract_id):
+        # Never raises (short of cancellation): an error returns _FAILED. The
+        # deadline is enforced by fetch(), which cancels this when it passes.
+        started = time.perf_counter()
+        try:
+            market_cap = await provider.fetch(session, contract_id)
+        except Exception as e:
+            latency = time.perf_counter() - started
+            provider.record(False)
+            metrics.QUOTE_FETCH_SECONDS.observe(latency, provider.name, 'error')
+            metrics.trace('quote.error', contract_id, provider=provider.name, error=str(e) or type(e).__name__)
+            return _FAILED
+        latency = time.perf_counter() - started
+        provider.record(True, latency, quoted=market_cap is not None)
+        metrics.QUOTE_FETCH_SECONDS.observe(latency, provider.name, 'empty' if market_cap is None else 'ok')
+        return market_cap
+
+
+def _expire(samples, before):
+    while samples and samples[0][0] < before:
+        samples.popleft()
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+import metrics
+
+
+class QuoteService:
+    # Market-cap quotes for every watch go through here:
+    #   - one aiohttp session, so connections to each provider are kept alive
+    #     and reused between polls instead of a TCP+TLS handshake per request;
+    #   - a short TTL cache keyed by contract id, bounded in size (oldest
+    #     entries are evicted first);
+    #   - single-flight: concurrent lookups for the same contract share one
+    #     upstream fetch.
+    #
+    # providers is a providers.ProviderPool, which picks, hedges and
+    # deadlines the upstream requests behind each miss.
+
+    def __init__(self, providers, ttl=1.0, max_entries=10000, pool_size=100):
+        self.providers = providers
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.pool_size = pool_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._cache = OrderedDict()  # contract_id -> (expires_at, (market_cap, source))
+        self._inflight = {}  # contract_id -> Future
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get(self, contract_id):
+        entry = self._cache.get(contract_id)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            del self._cache[contract_id]
+
+        inflight = self._inflight.get(contract_id)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[contract_id] = future
+        try:
+            quote = await self._fetch(contract_id)
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieve it so a future nobody else awaited doesn't log a warning.
+            future.exception()
+            raise
+        else:
+            future.set_result(quote)
+            if quote[0] is not None:
+                self._store(contract_id, quote)
+            return quote
+        finally:
+            del self._inflight[contract_id]
+            if not future.done():
+                future.cancel()
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'upstream': self.providers.requests,
+            'hitRate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            'cached': len(self._cache),
+            'inflight': len(self._inflight),
+            'providers': self.providers.stats(),
+        }
+
+    def _store(self, contract_id, quote):
+        self._cache[contract_id] = (time.monotonic() + self.ttl, quote)
+        self._cache.move_to_end(contract_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, contract_id):
+        metrics.QUOTE_LOOKUPS.inc()
+        return await self.providers.fetch(self.session(), contract_id)
@@ -0,0 +1,85 @@
+import asyncio
+import atexit
+from threading import Lock, Thread
+
+# One event loop for the whole process. The Telegram sender, the watch
+# scheduler and the quote service all live on it. Under `flask run` the loop
+# runs in a background thread and Flask handler threads hand work over with
+# submit(); serve.py instead binds the loop it serves HTTP on, so ingestion
+# runs on the same loop as everything else.
+_loop = None
+_loop_lock = Lock()
+_started = False
+_bound = False
+_startup = []
+_shutdown = []
+
+
+def bind(loop):
+    # Use a loop the caller runs itself. Must happen before anything calls
+    # get_loop(); the caller is then responsible for run_startup() and
+    # run_shutdown().
+    global _loop, _bound
+    with _loop_lock:
+        if _loop is not None and _loop is not loop:
+            raise RuntimeError('runtime loop already started')
+        _loop = loop
+        _bound = True
+
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            Thread(target=_loop.run_forever, name='runtime-loop', daemon=True).start()
+        return _loop
+
+
+def submit(coro):
+    # Schedule a coroutine on the shared loop from any thread and return a
+    # concurrent.futures.Future for its result.
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def on_startup(fn):
+    _startup.append(fn)
+    return fn
+
+
+def on_shutdown(fn):
+    _shutdown.append(fn)
+    return fn
+
+
+async def run_startup():
+    for fn in _startup:
+        await fn()
+
+
+async def run_shutdown():
+    for fn in reversed(_shutdown):
+        try:
+            await fn()
+        except Exception as e:
+            print(f"Error during shutdown in {fn.__name__}: {e}")
+
+
+def start():
+    # Background-thread mode: start the loop and the startup hooks now, and
+    # run the shutdown hooks when the interpreter exits. No-op when a loop
+    # has been bound.
+    global _started
+    with _loop_lock:
+        if _started or _bound:
+            return
+        _started = True
+    submit(run_startup())
+    atexit.register(_stop)
+
+
+def _stop():
+    try:
+        submit(run_shutdown()).result()
+    except Exception as e:
+        print(f"Error stopping runtime: {e}")
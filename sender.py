@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+from telethon import errors
+
+
+class TelegramSender:
+    # Owns the one connected Telegram client and a single outbound queue.
+    # Messages go out strictly in order; pacing follows Telegram's flood-wait
+    # responses instead of a fixed delay between messages.
+
+    def __init__(self, client):
+        self.client = client
+        # Surface every FloodWaitError to us instead of letting Telethon sleep
+        # inside send_message, so the whole queue pauses for the right amount.
+        self.client.flood_sleep_threshold = 0
+        self.queue = asyncio.Queue()
+        self._connecting = None
+        self._worker = None
+
+    async def start(self):
+        # Safe to call concurrently; everyone waits on the same connect.
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        try:
+            await self._connecting
+        except Exception:
+            self._connecting = None
+            raise
+
+    async def _connect(self):
+        # Not client.start(): on a session that isn't logged in it prompts
+        # for a phone number on stdin, which would block the event loop.
+        await self.client.connect()
+        if not await self.client.is_user_authorized():
+            await self.client.disconnect()
+            raise RuntimeError("Telegram session is not authorized, run generate_session.py")
+        self._worker = asyncio.create_task(self._run())
+        print("Telegram sender connected")
+
+    async def stop(self):
+        if self._connecting is not None and not self._connecting.done():
+            # Still connecting (e.g. Telegram is unreachable): give up.
+            self._connecting.cancel()
+            self._connecting = None
+            await self.client.disconnect()
+            return
+        if self._worker is None:
+            return
+        await self.queue.join()
+        self._worker.cancel()
+        self._worker = None
+        self._connecting = None
+        await self.client.disconnect()
+
+    def enqueue(self, chat_id, message):
+        # Returns a future that resolves to the send latency in seconds,
+        # measured from enqueue to Telegram acknowledging the message.
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((chat_id, message, time.monotonic(), future))
+        return future
+
+    async def _run(self):
+        while True:
+            chat_id, message, enqueued_at, future = await self.queue.get()
+            try:
+                await self._send_one(chat_id, message)
+                if not future.done():
+                    future.set_result(time.monotonic() - enqueued_at)
+            except Exception as e:
+                print(f"Error sending message {message}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def _send_one(self, chat_id, message):
+        while True:
+            try:
+                await self.client.send_message(chat_id, message)
+                return
+            except errors.FloodWaitError as e:
+                print(f"Flood wait from Telegram, pausing sends for {e.seconds}s")
+                await asyncio.sleep(e.seconds)
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import os
+
+from aiohttp import web
+
+import runtime
+
+# Production entry point. Serves the same endpoints as the Flask app, but on
+# an aiohttp server whose event loop is also the runtime loop, so ingestion,
+# the watch scheduler and the Telegram sender all share one loop. On SIGTERM
+# or SIGINT the server stops accepting requests, then runtime shutdown drains
+# in-flight watches (see stop_services in server.py).
+#
+#   python serve.py --host 0.0.0.0 --port 5001
+
+
+def json_response(result):
+    body, status = result
+    return web.json_response(body, status=status)
+
+
+@web.middleware
+async def cors(request, handler):
+    # The extractors post from arbitrary pages, same as CORS(app) on Flask.
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    return response
+
+
+def make_app(server):
+    async def save_contracts(request):
+        try:
+            data = await request.json()
+        except ValueError as e:
+            return web.json_response({'success': False, 'error': str(e)}, status=400)
+        return json_response(await server.handle_save_contract(data))
+
+    async def save_contracts_batch(request):
+        return json_response(await server.handle_save_batch(await request.text(), request.content_type))
+
+    async def get_contracts(request):
+        return json_response(await server.handle_get_contracts())
+
+    async def quote_stats(request):
+        return json_response(await server.handle_quote_stats())
+
+    async def get_metrics(request):
+        body, status = await server.handle_metrics()
+        return web.Response(text=body, status=status, content_type='text/plain')
+
+    async def list_watches(request):
+        return json_response(await server.handle_list_watches())
+
+    async def get_watch(request):
+        return json_response(await server.handle_get_watch(request.match_info['contract_key']))
+
+    async def cancel_watch(request):
+        return json_response(await server.handle_cancel_watch(request.match_info['contract_key']))
+
+    async def on_startup(app):
+        await runtime.run_startup()
+
+    async def on_cleanup(app):
+        await runtime.run_shutdown()
+
+    app = web.Application(middlewares=[cors])
+    app.router.add_post('/save_contracts', save_contracts)
+    app.router.add_post('/save_contracts/batch', save_contracts_batch)
+    app.router.add_get('/get_contracts', get_contracts)
+    app.router.add_get('/quote_stats', quote_stats)
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_get('/watches', list_watches)
+    app.router.add_get('/watches/{contract_key}', get_watch)
+    app.router.add_delete('/watches/{contract_key}', cancel_watch)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the contract watcher on aiohttp.')
+    parser.add_argument('--host', default=os.getenv('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 5001)))
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Bind before importing server, so its services attach to this loop
+    # instead of starting a background one.
+    runtime.bind(loop)
+    import server
+
+    web.run_app(make_app(server), host=args.host, port=args.port, loop=loop)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,18 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from telethon import TelegramClient
 from dotenv import load_dotenv
-import json
 import os
 import asyncio
-import sqlite3
-import concurrent.futures
-from threading import Lock
-import requests
-import time
-from bs4 import BeautifulSoup
+import metrics
+from providers import Provider, ProviderError, ProviderPool
+import runtime
+from extract import extract_geckoterminal_market_cap, extract_gmgn_market_cap
+from ingest import ingest_calls, parse_batch
+from sender import TelegramSender
+from store import ContractStore
+from quotes import QuoteService
+from watcher import SchedulerFull, Watch, WatchScheduler
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,180 +26,346 @@ IP = os.getenv('IP')
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
-# Initialize contract sets and locks
-contract_ids = set()
-sent_contract_ids = set()
-db_lock = Lock()
-executor = concurrent.futures.ThreadPoolExecutor()
-processing_lock = Lock()
+# Contracts we've been called on and the ones already alerted on. Loaded at
+# import so every launch path (flask run, python server.py) sees the same
+# dedupe state; the old JSON files are imported once.
+store = ContractStore(os.getenv('CONTRACTS_DB', 'contracts.db'))
+store.import_json('contracts.json', 'sent_contracts.json')
 
-# Initialize Telegram client
+# Watch settings: how long to wait for the drop after the first alert and how
+# far the market cap has to fall. Poll intervals are per quote source, below.
+WATCH_TIMEOUT = float(os.getenv('WATCH_TIMEOUT', 10))
+DROP_THRESHOLD = float(os.getenv('DROP_THRESHOLD', 0.40))
+MAX_CONCURRENT_POLLS = int(os.getenv('MAX_CONCURRENT_POLLS', 50))
+# How long a new call may wait for a quote source to answer at all (during
+# an outage) before it is given up on, without marking the contract alerted.
+MAX_DEFER = float(os.getenv('MAX_DEFER', 60))
+
+# Admission control: how many watches we hold before shedding or answering
+# 429, which source channels win when we have to choose (comma separated,
+# highest first), and whether newer calls win over older ones.
+MAX_WATCHES = int(os.getenv('MAX_WATCHES', 5000))
+PRIORITY_CHANNELS = [c.strip() for c in os.getenv('PRIORITY_CHANNELS', '').split(',') if c.strip()]
+SHED_OLDEST = os.getenv('SHED_OLDEST', '1') != '0'
+# How long shutdown waits for in-flight watches before saving them.
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', WATCH_TIMEOUT + 5))
+
+# Initialize Telegram client. It is connected once on the runtime loop and
+# shared by every alert for the lifetime of the process.
 client = TelegramClient('session_name', api_id, api_hash)
+sender = TelegramSender(client)
 
-def parse_market_cap(market_cap_str):
-    market_cap_str = market_cap_str.lower()
-    if 'k' in market_cap_str:
-        value = float(market_cap_str.replace('$', '').replace(',', '').replace('k', '')) * 1000
-    elif 'm' in market_cap_str:
-        value = float(market_cap_str.replace('$', '').replace(',', '').replace('m', '')) * 1000000
-    else:
-        value = float(market_cap_str.replace('$', '').replace(',', ''))
-    return round(value, 1)
+# Provider base URLs; overridable so the benchmarks can point at local fakes.
+GMGN_URL = os.getenv('GMGN_URL', 'https://gmgn.ai')
+GECKOTERMINAL_URL = os.getenv('GECKOTERMINAL_URL', 'https://www.geckoterminal.com')
+GECKOTERMINAL_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache',
+}
 
-def get_current_market_cap(contract_id):
-    market_cap, source = get_market_cap_from_gmgn(contract_id)
-    if market_cap is None:
-        market_cap, source = get_market_cap_from_geckoterminal(contract_id)
-    return market_cap, source
+# Provider fetches return None when the source has no market cap for the token
+# (not indexed yet, null field) and raise when the source itself is failing
+# (network errors, 5xx, rate limiting), which counts against its breaker.
 
-def get_market_cap_from_gmgn(contract_id):
-    url = f'https://gmgn.ai/sol/token/{contract_id}'
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            response_text = response.text
-            start_index = response_text.find('"market_cap":') + len('"market_cap":')
-            end_index = response_text.find(',', start_index)
-            market_cap = response_text[start_index:end_index].strip()
-            return parse_market_cap(market_cap), 'gmgn'
-        else:
-            print(f"Failed to retrieve data from GMGN: {response.status_code}")
-            return None, 'gmgn'
-    except Exception as e:
-        print(f"Error fetching market cap from GMGN for {contract_id}: {e}")
-        return None, 'gmgn'
-
-def get_market_cap_from_geckoterminal(contract_id):
-    url = f'https://www.geckoterminal.com/solana/pools/{contract_id}'
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
-        'Cache-Control': 'no-cache',
-        'Pragma': 'no-cache',
-        'Connection': 'close'  # Ensure the connection is not reused
-    }
+def _check_status(response, provider):
+    if response.status >= 500 or response.status == 429:
+        raise ProviderError(f"{provider} answered HTTP {response.status}")
+    return response.status == 200
+
+def _parse(extract, html, contract_id, provider):
+    with metrics.PARSE_SECONDS.time(provider):
+        try:
+            return extract(html)
+        except ValueError as e:
+            metrics.trace('quote.unparsed', contract_id, provider=provider, error=str(e))
+            return None
+
+async def get_market_cap_from_gmgn(session, contract_id):
+    url = f'{GMGN_URL}/sol/token/{contract_id}'
+    async with session.get(url) as response:
+        if not _check_status(response, 'gmgn'):
+            return None
+        html = await response.text()
+    return _parse(extract_gmgn_market_cap, html, contract_id, 'gmgn')
+
+async def get_market_cap_from_geckoterminal(session, contract_id):
+    url = f'{GECKOTERMINAL_URL}/solana/pools/{contract_id}'
+    async with session.get(url, headers=GECKOTERMINAL_HEADERS) as response:
+        if not _check_status(response, 'geckoterminal'):
+            return None
+        html = await response.text()
+    return _parse(extract_geckoterminal_market_cap, html, contract_id, 'geckoterminal')
+
+# Quote sources, in order of preference until we have latency and health
+# samples for them. Each request gets QUOTE_TIMEOUT seconds; the next source is
+# also asked once the current one is slower than its HEDGE_PERCENTILE latency.
+# BREAKER_FAILURES failures in a row take a source out of rotation for
+# BREAKER_RESET seconds.
+QUOTE_TIMEOUT = float(os.getenv('QUOTE_TIMEOUT', 5))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_RESET = float(os.getenv('BREAKER_RESET', 30))
+providers = ProviderPool(
+    [
+        Provider('gmgn', get_market_cap_from_gmgn, float(os.getenv('POLL_INTERVAL_GMGN', 2)),
+                 timeout=QUOTE_TIMEOUT, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET),
+        Provider('geckoterminal', get_market_cap_from_geckoterminal, float(os.getenv('POLL_INTERVAL_GECKOTERMINAL', 5)),
+                 timeout=QUOTE_TIMEOUT, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET),
+    ],
+    hedge_percentile=float(os.getenv('HEDGE_PERCENTILE', 95)),
+)
+
+quotes = QuoteService(
+    providers,
+    ttl=float(os.getenv('QUOTE_TTL', 1.0)),
+    max_entries=int(os.getenv('QUOTE_CACHE_SIZE', 10000)),
+)
+
+# Endpoint logic. Each handler runs on the runtime loop and returns
+# (body, status); the Flask routes below and the aiohttp app in serve.py are
+# thin adapters over them.
+
+async def handle_save_contract(data):
+    with metrics.INGEST_SECONDS.time('single'):
+        result = (await ingest([data]))[0]
+    if result['status'] == 'invalid':
+        print(f"Error parsing call {data}: {result['error']}")
+        return {'success': False, 'error': result['error']}, 400
+    if result['status'] == 'rejected':
+        return {'success': False, 'error': result['error']}, 429
+    return {'success': True}, 200
+
+async def handle_save_batch(body, content_type):
+    # Body is a JSON array of calls, {"source": ..., "calls": [...]}, or
+    # NDJSON (Content-Type: application/x-ndjson). Returns one result per call.
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        market_cap_th = soup.find('th', string='Market Cap')
-        if market_cap_th:
-            market_cap_td = market_cap_th.find_next('td', class_='number-1')
-            if market_cap_td:
-                market_cap_span = market_cap_td.find('span')
-                if market_cap_span:
-                    market_cap_value = market_cap_span.text.strip()
-                    return parse_market_cap(market_cap_value), 'geckoterminal'
-    except Exception as e:
-        print(f"Error fetching market cap from GeckoTerminal for {contract_id}: {e}")
-    return None, 'geckoterminal'
+        source, items = parse_batch(body, content_type)
+    except ValueError as e:
+        print(f"Error parsing batch: {e}")
+        return {'success': False, 'error': str(e)}, 400
+
+    with metrics.INGEST_SECONDS.time('batch'):
+        results = await ingest(items, source)
+    accepted = sum(result['status'] == 'accepted' for result in results)
+    rejected = sum(result['status'] == 'rejected' for result in results)
+    status = 429 if rejected and not accepted else 200
+    return {'success': status == 200, 'accepted': accepted, 'results': results}, status
+
+async def handle_get_contracts():
+    return store.list_contracts(), 200
+
+async def handle_quote_stats():
+    return quotes.stats(), 200
+
+async def handle_metrics():
+    return metrics.render(), 200
+
+async def handle_list_watches():
+    return scheduler.snapshot(), 200
+
+async def handle_get_watch(contract_key):
+    watch = scheduler.get(contract_key)
+    if watch is None:
+        return {'success': False, 'error': 'not watched'}, 404
+    return watch.to_dict(), 200
+
+async def handle_cancel_watch(contract_key):
+    watch = scheduler.cancel(contract_key)
+    if watch is None:
+        return {'success': False, 'error': 'not watched'}, 404
+    return {'success': True, 'watch': watch.to_dict()}, 200
+
+def _respond(handler):
+    body, status = runtime.submit(handler).result()
+    return jsonify(body), status
 
 @app.route('/save_contracts', methods=['POST'])
 def save_contracts():
-    data = request.get_json()
-    contract_key = data.get('contractKey')
-    market_cap_str = data.get('marketCap')
-    try:
-        called_market_cap = parse_market_cap(market_cap_str)
-    except ValueError as e:
-        print(f"Error parsing market cap {market_cap_str}: {e}")
-        return jsonify(success=False, error=str(e)), 400
+    return _respond(handle_save_contract(request.get_json()))
 
-    if contract_key and contract_key not in contract_ids:
-        contract_ids.add((contract_key, called_market_cap))
-        with open('contracts.json', 'w') as f:
-            json.dump(list(contract_ids), f)
-        executor.submit(process_contract, contract_key, called_market_cap)
-    return jsonify(success=True)
+@app.route('/save_contracts/batch', methods=['POST'])
+def save_contracts_batch():
+    return _respond(handle_save_batch(request.get_data(as_text=True), request.content_type))
 
 @app.route('/get_contracts', methods=['GET'])
 def get_contracts():
-    return jsonify(list(contract_ids))
+    return _respond(handle_get_contracts())
 
-def load_json(file_path):
-    if os.path.exists(file_path):
-        try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                return {tuple(item) for item in data}
-        except json.JSONDecodeError:
-            return set()
-    return set()
+@app.route('/quote_stats', methods=['GET'])
+def quote_stats():
+    return _respond(handle_quote_stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body, status = runtime.submit(handle_metrics()).result()
+    return Response(body, status, mimetype='text/plain')
 
-def save_json(file_path, data):
-    with open(file_path, 'w') as f:
-        json.dump(list(data), f)
+@app.route('/watches', methods=['GET'])
+def list_watches():
+    return _respond(handle_list_watches())
+
+@app.route('/watches/<contract_key>', methods=['GET'])
+def get_watch(contract_key):
+    return _respond(handle_get_watch(contract_key))
+
+@app.route('/watches/<contract_key>', methods=['DELETE'])
+def cancel_watch(contract_key):
+    return _respond(handle_cancel_watch(contract_key))
 
 async def send_messages(chat_id, messages):
-    async with TelegramClient('session_name', api_id, api_hash) as client:
+    # Enqueue everything first so the messages go out back to back, then
+    # collect per-message send latencies.
+    await sender.start()
+    futures = [sender.enqueue(chat_id, message) for message in messages]
+    latencies = await asyncio.gather(*futures)
+    for latency in latencies:
+        metrics.SEND_SECONDS.observe(latency)
+    return latencies
+
+def alert(watch):
+    # Called by the scheduler the moment an alert is due. The contract is
+    # marked as alerted right away, before the send is even queued, so a
+    # repeat call can't start a second watch (and a second buy message) while
+    # this one waits out a FloodWait. Returns the send, which the scheduler
+    # runs as its own task.
+    kind = 'call' if watch.status == 'pending' else 'drop'
+    store.mark_sent(watch.contract_key, watch.called_market_cap)
+    return send_alert(watch, kind)
+
+async def send_alert(watch, kind):
+    try:
+        latencies = await send_messages(chat_id, [f"{watch.contract_key}"])
+    except Exception as e:
+        metrics.trace('alert.error', watch.contract_key, watch.trace_id, kind=kind, error=str(e))
+    else:
+        metrics.ALERTS.inc(kind)
+        metrics.trace('alert.sent', watch.contract_key, watch.trace_id, kind=kind,
+                      sendMs=round(latencies[0] * 1000, 2), marketCap=watch.current_market_cap)
+
+def watch_done(watch):
+    # The first quote failing still counts as handled, like an alert.
+    if watch.status == 'failed':
+        store.mark_sent(watch.contract_key, watch.called_market_cap)
+
+scheduler = WatchScheduler(
+    quotes.get,
+    alert,
+    on_done=watch_done,
+    max_concurrency=MAX_CONCURRENT_POLLS,
+    poll_intervals=providers.poll_intervals(),
+    max_watches=MAX_WATCHES,
+    priority_channels=PRIORITY_CHANNELS,
+    shed_oldest=SHED_OLDEST,
+    max_defer=MAX_DEFER,
+)
+
+# Gauges read when /metrics is rendered.
+metrics.Gauge('active_watches', 'Watches currently held by the scheduler.', lambda: len(scheduler.watches))
+metrics.Gauge('scheduler_queue_depth', 'Entries in the poll heap, including lazily dropped ones.',
+              lambda: scheduler.stats()['scheduled'])
+metrics.Gauge('polls_in_flight', 'Quote polls currently running.', lambda: scheduler.stats()['polling'])
+metrics.Gauge('alerts_in_flight', 'Alert tasks not yet finished.', lambda: scheduler.stats()['alerting'])
+metrics.Gauge('send_queue_depth', 'Telegram messages waiting to be sent.', lambda: sender.queue.qsize())
+metrics.Gauge('quote_cache_lookups_total', 'Quote lookups by how they were served.',
+              lambda: {(name,): quotes.stats()[name] for name in ('hits', 'misses', 'coalesced')},
+              labelnames=('result',), kind='counter')
+metrics.Gauge('provider_health', 'Share of recent requests each quote source answered (errors and timeouts count against it).',
+              lambda: {(name,): s['health'] for name, s in providers.stats().items()}, labelnames=('provider',))
+metrics.Gauge('provider_breaker_open', '1 while a quote source is out of rotation (open or half-open breaker).',
+              lambda: {(name,): int(s['state'] != 'closed') for name, s in providers.stats().items()},
+              labelnames=('provider',))
+metrics.Gauge('provider_primary', '1 for the quote source currently asked first.',
+              lambda: {(name,): int(s['primary']) for name, s in providers.stats().items()}, labelnames=('provider',))
+metrics.Gauge('provider_hedge_delay_seconds', 'How long a request to each source runs before the next is asked too.',
+              lambda: {(name,): s['hedgeDelay'] for name, s in providers.stats().items()}, labelnames=('provider',))
+metrics.Gauge('watches_turned_away_total', 'Watches shed to admit higher-priority calls, or rejected outright.',
+              lambda: {('shed',): scheduler.shed, ('rejected',): scheduler.rejected},
+              labelnames=('reason',), kind='counter')
+
+async def ingest(items, source=None):
+    # Dedupe and record the calls, then start watches for the new ones.
+    results, accepted = ingest_calls(items, store, source)
+    if accepted:
+        statuses = watch_contracts(accepted)
+        for result in results:
+            if result['status'] == 'accepted':
+                status, error = statuses[result['contractKey']]
+                result['status'] = status
+                if error:
+                    result['error'] = error
+    for result in results:
+        metrics.INGEST_CALLS.inc(result['status'])
+    return results
+
+def watch_contracts(calls):
+    # Returns {contract_key: (status, error)} with status 'accepted' for a new
+    # watch, 'watching' if one is already running, 'sent' or 'rejected'.
+    statuses = {}
+    for call in calls:
+        contract_key = call['contractKey']
+        if store.is_sent(contract_key):
+            statuses[contract_key] = ('sent', None)
+            continue
+        watch = Watch(
+            contract_key,
+            call['marketCap'],
+            channel=call['source'],
+            timeout=WATCH_TIMEOUT,
+            drop_threshold=DROP_THRESHOLD,
+        )
         try:
-            await client.start()
-            for message in messages:
-                print(f"Sending message: {message}")
-                await client.send_message(chat_id, message)
-                await asyncio.sleep(1)  # Delay between messages
-        except sqlite3.OperationalError as e:
-            print(f"SQLite error: {e}")
-        except Exception as e:
-            print(f"Error sending messages: {e}")
-
-def process_contract(contract_key, called_market_cap):
-    asyncio.run(_process_contract(contract_key, called_market_cap))
-
-async def _process_contract(contract_key, called_market_cap):
-    global sent_contract_ids
-
-    sent_contract_ids = load_json('sent_contracts.json')
-
-    if (contract_key, called_market_cap) not in sent_contract_ids:
-        print(f"Checking contract {contract_key} with called market cap {called_market_cap}")
-        current_market_cap, source = get_current_market_cap_with_source(contract_key)
-        if current_market_cap is None:
-            print(f"Skipping contract {contract_key} due to error fetching market cap")
-            with db_lock:
-                sent_contract_ids.add((contract_key, called_market_cap))
-                save_json('sent_contracts.json', sent_contract_ids)
-            return
-
-        print(f"Current market cap for {contract_key} is {current_market_cap}")
-        initial_market_cap = current_market_cap
-        
-        # Instantly send a message
-        messages = [f"{contract_key}"]
-        await send_messages(chat_id, messages)
-        with db_lock:
-            sent_contract_ids.add((contract_key, called_market_cap))
-            save_json('sent_contracts.json', sent_contract_ids)
-        
-        # Start watching for market cap drop
-        start_time = time.time()
-        while True:
-            if time.time() - start_time > 10:  # 10 sec for now
-                print(f"Contract {contract_key} not satisfied within 5 minutes")
-                return
-
-            if current_market_cap <= initial_market_cap * 0.40:
-                print(f"Market cap dropped 60% for {contract_key} (Current: {current_market_cap}, Initial: {initial_market_cap})")
-                messages = [f"{contract_key}"]
-                await send_messages(chat_id, messages)
-                with db_lock:
-                    sent_contract_ids.add((contract_key, called_market_cap))
-                    save_json('sent_contracts.json', sent_contract_ids)
-                return
-
-            print(f"Waiting for market cap to drop for {contract_key} (Current: {current_market_cap}, Initial: {initial_market_cap})")
-            await asyncio.sleep(2 if source == 'gmgn' else 5)  # Adjust sleep based on source
-            current_market_cap, source = get_current_market_cap_with_source(contract_key)
-            if current_market_cap is None:
-                print(f"Skipping contract {contract_key} due to error fetching market cap during waiting")
-                return
-
-def get_current_market_cap_with_source(contract_id):
-    market_cap, source = get_market_cap_from_gmgn(contract_id)
-    if market_cap is None:
-        market_cap, source = get_market_cap_from_geckoterminal(contract_id)
-    return market_cap, source
+            added = scheduler.add(watch)
+        except SchedulerFull as e:
+            metrics.trace('watch.rejected', contract_key, watch.trace_id, channel=watch.channel, error=str(e))
+            statuses[contract_key] = ('rejected', f"overloaded: {e}")
+            continue
+        if added:
+            metrics.trace('watch.started', contract_key, watch.trace_id, channel=watch.channel,
+                          calledMarketCap=call['marketCap'])
+        statuses[contract_key] = ('accepted' if added else 'watching', None)
+    return statuses
+
+def resume_watches():
+    # Pick up watches that were still running when the last process drained.
+    for state in store.take_pending():
+        watch = Watch.from_dict(state)
+        if watch.status == 'pending' and store.is_sent(watch.contract_key):
+            continue
+        try:
+            scheduler.add(watch)
+            metrics.trace('watch.resumed', watch.contract_key, watch.trace_id, status=watch.status)
+        except SchedulerFull as e:
+            metrics.trace('watch.rejected', watch.contract_key, watch.trace_id, error=str(e))
+
+async def connect_sender():
+    try:
+        await sender.start()
+    except Exception as e:
+        print(f"Error connecting Telegram sender: {e}")
+
+sender_connect = None
+
+@runtime.on_startup
+async def start_services():
+    global sender_connect
+    scheduler.start()
+    resume_watches()
+    # Connect to Telegram in the background so ingestion and the scheduler
+    # don't wait on it; alerts wait for the connection in send_messages.
+    sender_connect = asyncio.ensure_future(connect_sender())
+
+@runtime.on_shutdown
+async def stop_services():
+    # Let in-flight watches finish; whatever is left after DRAIN_TIMEOUT is
+    # saved and resumed on the next start.
+    leftover = await scheduler.drain(DRAIN_TIMEOUT)
+    if leftover:
+        print(f"Saving {len(leftover)} unfinished watches")
+        store.save_pending([watch.to_dict() for watch in leftover])
+    await sender.stop()
+    await quotes.close()
+
+runtime.start()
 
 if __name__ == "__main__":
-    contract_ids = load_json('contracts.json')
-    sent_contract_ids = load_json('sent_contracts.json')
     app.run(host='127.0.0.1', port=int(os.getenv('PORT', 5001)))
@@ -7,8 +7,8 @@ python generate_session.py
 if [ -f /usr/src/app/session_name.session ]; then
   echo "Session file created successfully."
 
-  # Start the Flask application
-  flask run --host=0.0.0.0 --port=${PORT}
+  # Start the production server
+  python serve.py --host 0.0.0.0 --port ${PORT}
 else
   echo "Failed to create session file."
   exit 1
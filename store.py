@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class ContractStore:
+    # Durable record of every contract we've been called on and every one
+    # we've already alerted on. SQLite in WAL mode makes each write a small
+    # append instead of rewriting a whole JSON file, and the in-memory
+    # index answers membership checks without touching disk.
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS contracts (
+                contract_key TEXT PRIMARY KEY,
+                called_market_cap REAL,
+                added_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS sent_contracts (
+                contract_key TEXT PRIMARY KEY,
+                called_market_cap REAL,
+                sent_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS pending_watches (
+                contract_key TEXT PRIMARY KEY,
+                state TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        ''')
+        self.contracts = dict(self._db.execute('SELECT contract_key, called_market_cap FROM contracts ORDER BY rowid'))
+        self.sent = {row[0] for row in self._db.execute('SELECT contract_key FROM sent_contracts')}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def import_json(self, contracts_path, sent_path):
+        # One-time import of the contracts.json / sent_contracts.json files the
+        # server used to keep. Both hold lists of [contract_key, market_cap].
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+                return
+            contracts = _read_pairs(contracts_path)
+            sent = _read_pairs(sent_path)
+            now = time.time()
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO contracts VALUES (?, ?, ?)',
+                    [(key, market_cap, now) for key, market_cap in contracts],
+                )
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO sent_contracts VALUES (?, ?, ?)',
+                    [(key, market_cap, now) for key, market_cap in sent],
+                )
+                self._db.execute("INSERT INTO meta VALUES ('json_imported', ?)", (str(now),))
+            for key, market_cap in contracts:
+                self.contracts.setdefault(key, market_cap)
+            self.sent.update(key for key, _ in sent)
+        if contracts or sent:
+            print(f"Imported {len(contracts)} contracts and {len(sent)} sent contracts from JSON")
+
+    def add_contract(self, contract_key, called_market_cap):
+        # Returns False if the contract was already known.
+        with self._lock:
+            if contract_key in self.contracts:
+                return False
+            self._db.execute(
+                'INSERT OR IGNORE INTO contracts VALUES (?, ?, ?)',
+                (contract_key, called_market_cap, time.time()),
+            )
+            self.contracts[contract_key] = called_market_cap
+            return True
+
+    def add_contracts(self, pairs):
+        # Batch form of add_contract: one transaction for the whole batch.
+        # Returns the set of contract keys that were new.
+        with self._lock:
+            new = {}
+            for contract_key, called_market_cap in pairs:
+                if contract_key not in self.contracts and contract_key not in new:
+                    new[contract_key] = called_market_cap
+            if new:
+                now = time.time()
+                with self._db:
+                    self._db.execute('BEGIN')
+                    self._db.executemany(
+                        'INSERT OR IGNORE INTO contracts VALUES (?, ?, ?)',
+                        [(key, market_cap, now) for key, market_cap in new.items()],
+                    )
+                self.contracts.update(new)
+            return set(new)
+
+    def is_sent(self, contract_key):
+        return contract_key in self.sent
+
+    def mark_sent(self, contract_key, called_market_cap):
+        with self._lock:
+            if contract_key in self.sent:
+                return
+            self._db.execute(
+                'INSERT OR IGNORE INTO sent_contracts VALUES (?, ?, ?)',
+                (contract_key, called_market_cap, time.time()),
+            )
+            self.sent.add(contract_key)
+
+    def save_pending(self, states):
+        # Watches that were still running at shutdown, as Watch.to_dict()
+        # states, so the next start can pick them up again.
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO pending_watches VALUES (?, ?)',
+                    [(state['contractKey'], json.dumps(state)) for state in states],
+                )
+
+    def take_pending(self):
+        with self._lock:
+            with self._db:
+                self._db.execute('BEGIN')
+                rows = self._db.execute('SELECT state FROM pending_watches').fetchall()
+                self._db.execute('DELETE FROM pending_watches')
+            return [json.loads(row[0]) for row in rows]
+
+    def list_contracts(self):
+        with self._lock:
+            return [[key, market_cap] for key, market_cap in self.contracts.items()]
+
+
+def _read_pairs(file_path):
+    # [[contract_key, market_cap], ...] from an old JSON file. Missing or
+    # unreadable files (e.g. a directory left by a bind mount) and malformed
+    # entries are skipped.
+    if not os.path.isfile(file_path):
+        return []
+    try:
+        with open(file_path, 'r') as f:
+            items = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Skipping unreadable {file_path}: {e}")
+        return []
+    if not isinstance(items, list):
+        print(f"Skipping {file_path}: expected a list of [contract_key, market_cap] pairs")
+        return []
+    pairs = []
+    for item in items:
+        if isinstance(item, (list, tuple)) and len(item) == 2 and isinstance(item[0], str):
+            pairs.append((item[0], item[1]))
+        else:
+            print(f"Skipping malformed entry in {file_path}: {item!r}")
+    return pairs
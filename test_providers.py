@@ -0,0 +1,167 @@
+import asyncio
+import unittest
+
+import metrics
+from providers import NoProviderAvailable, Provider, ProviderError, ProviderPool, ProvidersFailed
+from watcher import RetryLater, Watch, WatchScheduler
+
+metrics.TRACE = False
+
+
+def provider(name, answers, **kwargs):
+    # answers: a list of market caps / exceptions / ('sleep', seconds, value),
+    # consumed one per request; the last one repeats.
+    calls = []
+
+    async def fetch(session, contract_id):
+        answer = answers[min(len(calls), len(answers) - 1)]
+        calls.append(contract_id)
+        if isinstance(answer, tuple):
+            await asyncio.sleep(answer[1])
+            answer = answer[2]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    kwargs.setdefault('timeout', 1.0)
+    p = Provider(name, fetch, poll_interval=2, **kwargs)
+    p.calls = calls
+    return p
+
+
+class BreakerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_missing_market_cap_does_not_open_breaker(self):
+        gmgn = provider('gmgn', [None], failure_threshold=3)
+        gecko = provider('geckoterminal', [None], failure_threshold=3)
+        pool = ProviderPool([gmgn, gecko])
+        for _ in range(10):
+            market_cap, _ = await pool.fetch(None, 'new-token')
+            self.assertIsNone(market_cap)
+        self.assertEqual(gmgn.state(), 'closed')
+        self.assertEqual(gecko.state(), 'closed')
+
+    async def test_errors_open_breaker_and_skip_provider(self):
+        gmgn = provider('gmgn', [ProviderError('HTTP 503')], failure_threshold=3, reset_timeout=60)
+        gecko = provider('geckoterminal', [42.0])
+        pool = ProviderPool([gmgn, gecko])
+        for _ in range(3):
+            self.assertEqual(await pool.fetch(None, 'x'), (42.0, 'geckoterminal'))
+        self.assertEqual(gmgn.state(), 'open')
+        await pool.fetch(None, 'x')
+        self.assertEqual(len(gmgn.calls), 3)
+
+    async def test_no_provider_available_asks_to_retry(self):
+        gmgn = provider('gmgn', [ProviderError('HTTP 500')], failure_threshold=1, reset_timeout=30)
+        gecko = provider('geckoterminal', [ProviderError('HTTP 500')], failure_threshold=1, reset_timeout=10)
+        pool = ProviderPool([gmgn, gecko])
+        with self.assertRaises(ProvidersFailed) as raised:
+            await pool.fetch(None, 'x')
+        self.assertTrue(9 < raised.exception.delay <= 10)
+        with self.assertRaises(RetryLater) as raised:
+            await pool.fetch(None, 'x')
+        self.assertIsInstance(raised.exception, NoProviderAvailable)
+        self.assertTrue(9 < raised.exception.delay <= 10)
+
+    async def test_errors_below_threshold_ask_to_retry(self):
+        # Breakers still closed: retry after the poll interval rather than
+        # reporting no quote.
+        gmgn = provider('gmgn', [ProviderError('HTTP 503')], failure_threshold=5)
+        gecko = provider('geckoterminal', [ConnectionResetError()], failure_threshold=5)
+        pool = ProviderPool([gmgn, gecko])
+        with self.assertRaises(ProvidersFailed) as raised:
+            await pool.fetch(None, 'x')
+        self.assertEqual(raised.exception.delay, 2)
+        self.assertEqual(gmgn.state(), 'closed')
+
+    async def test_error_then_no_market_cap_is_no_quote(self):
+        gmgn = provider('gmgn', [ProviderError('HTTP 503')])
+        gecko = provider('geckoterminal', [None])
+        pool = ProviderPool([gmgn, gecko])
+        self.assertEqual(await pool.fetch(None, 'x'), (None, 'geckoterminal'))
+
+    async def test_half_open_probe_closes_breaker(self):
+        gmgn = provider('gmgn', [ProviderError('HTTP 500'), 7.0], failure_threshold=1, reset_timeout=0.05)
+        pool = ProviderPool([gmgn])
+        with self.assertRaises(ProvidersFailed):
+            await pool.fetch(None, 'x')
+        self.assertEqual(gmgn.state(), 'open')
+        await asyncio.sleep(0.06)
+        self.assertEqual(gmgn.state(), 'half_open')
+        self.assertEqual(await pool.fetch(None, 'x'), (7.0, 'gmgn'))
+        self.assertEqual(gmgn.state(), 'closed')
+
+
+class RankingTest(unittest.IsolatedAsyncioTestCase):
+    async def test_fast_empty_answers_do_not_make_primary(self):
+        gecko = provider('geckoterminal', [('sleep', 0.005, None)])
+        gmgn = provider('gmgn', [('sleep', 0.05, 100.0)])
+        pool = ProviderPool([gecko, gmgn])
+        for _ in range(5):
+            self.assertEqual(await pool.fetch(None, 'x'), (100.0, 'gmgn'))
+        self.assertEqual(pool.primary(), 'gmgn')
+        self.assertEqual(len(gecko.calls), 1)
+        self.assertEqual(gecko.state(), 'closed')
+
+
+class HedgeTest(unittest.IsolatedAsyncioTestCase):
+    async def test_slow_primary_is_hedged(self):
+        gmgn = provider('gmgn', [('sleep', 0.5, 1.0)])
+        gecko = provider('geckoterminal', [('sleep', 0.01, 2.0)])
+        pool = ProviderPool([gmgn, gecko], min_hedge_delay=0.02, default_hedge_delay=0.05)
+        started = asyncio.get_running_loop().time()
+        self.assertEqual(await pool.fetch(None, 'x'), (2.0, 'geckoterminal'))
+        self.assertLess(asyncio.get_running_loop().time() - started, 0.3)
+        self.assertEqual(len(gmgn.calls), 1)
+        self.assertEqual(len(gmgn.latencies), 1)  # the cancelled request counts as slow
+
+    async def test_hung_provider_hits_deadline(self):
+        gmgn = provider('gmgn', [('sleep', 10, 1.0)], timeout=0.05, failure_threshold=2)
+        pool = ProviderPool([gmgn])
+        started = asyncio.get_running_loop().time()
+        with self.assertRaises(ProvidersFailed):
+            await pool.fetch(None, 'x')
+        self.assertLess(asyncio.get_running_loop().time() - started, 0.5)
+        self.assertEqual(gmgn.failures, 1)
+
+
+class DeferTest(unittest.IsolatedAsyncioTestCase):
+    async def test_retry_later_defers_watch_instead_of_failing(self):
+        answers = [RetryLater(0.05), (100.0, 'gmgn')]
+        done = []
+
+        async def fetch(contract_key):
+            answer = answers.pop(0) if len(answers) > 1 else answers[0]
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        alerted = []
+
+        def on_alert(watch):
+            alerted.append(watch.contract_key)
+            return asyncio.sleep(0)
+
+        scheduler = WatchScheduler(fetch, on_alert, on_done=done.append)
+        scheduler.add(Watch('x', 100.0, timeout=5))
+        await asyncio.sleep(0.2)
+        self.assertEqual(done, [])
+        self.assertEqual(alerted, ['x'])
+        self.assertEqual(scheduler.get('x').status, 'watching')
+        await scheduler.stop()
+
+    async def test_pending_watch_gives_up_after_max_defer(self):
+        async def fetch(contract_key):
+            raise RetryLater(0.02)
+
+        done = []
+        scheduler = WatchScheduler(fetch, lambda watch: asyncio.sleep(0), on_done=done.append, max_defer=0.1)
+        scheduler.add(Watch('x', 100.0, timeout=5))
+        await asyncio.sleep(0.05)
+        self.assertEqual(done, [])
+        await asyncio.sleep(0.15)
+        self.assertEqual([(watch.contract_key, watch.status) for watch in done], [('x', 'unavailable')])
+        await scheduler.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
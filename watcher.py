@@ -0,0 +1,344 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+
+import metrics
+
+DEFAULT_POLL_INTERVAL = 2
+DEFAULT_TIMEOUT = 10  # seconds to wait for the drop after the first alert
+DEFAULT_DROP_THRESHOLD = 0.40  # alert once market cap falls to 40% of initial
+DEFAULT_MAX_DEFER = 60  # seconds a pending watch may wait for a quote source
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class RetryLater(Exception):
+    # Raised by fetch when no quote source can be asked right now; the poll
+    # is retried after delay seconds without counting against the watch.
+    def __init__(self, delay, message=None):
+        super().__init__(message or f"retry in {delay}s")
+        self.delay = delay
+
+
+@dataclass
+class Watch:
+    contract_key: str
+    called_market_cap: float
+    channel: str = None  # which extractor reported the call
+    poll_interval: float = DEFAULT_POLL_INTERVAL
+    timeout: float = DEFAULT_TIMEOUT
+    drop_threshold: float = DEFAULT_DROP_THRESHOLD
+    status: str = 'pending'
+    initial_market_cap: float = None
+    current_market_cap: float = None
+    source: str = None
+    polls: int = 0
+    created_at: float = field(default_factory=time.time)
+    deadline: float = None  # monotonic, set once the first alert is out
+    next_poll: float = 0.0  # monotonic
+    deferred_since: float = None  # monotonic, while polls are being put off
+    trace_id: str = field(default_factory=metrics.new_trace_id)
+
+    def to_dict(self):
+        now = time.monotonic()
+        return {
+            'contractKey': self.contract_key,
+            'calledMarketCap': self.called_market_cap,
+            'channel': self.channel,
+            'status': self.status,
+            'initialMarketCap': self.initial_market_cap,
+            'currentMarketCap': self.current_market_cap,
+            'source': self.source,
+            'polls': self.polls,
+            'pollInterval': self.poll_interval,
+            'dropThreshold': self.drop_threshold,
+            'timeout': self.timeout,
+            'createdAt': self.created_at,
+            'secondsLeft': None if self.deadline is None else max(0.0, self.deadline - now),
+            'nextPollIn': max(0.0, self.next_poll - now),
+            'traceId': self.trace_id,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        # Rebuild a watch saved with to_dict(), e.g. across a restart.
+        watch = cls(
+            state['contractKey'],
+            state['calledMarketCap'],
+            channel=state.get('channel'),
+            poll_interval=state.get('pollInterval', DEFAULT_POLL_INTERVAL),
+            timeout=state.get('timeout', DEFAULT_TIMEOUT),
+            drop_threshold=state.get('dropThreshold', DEFAULT_DROP_THRESHOLD),
+            created_at=state.get('createdAt', time.time()),
+        )
+        if state.get('traceId'):
+            watch.trace_id = state['traceId']
+        if state.get('initialMarketCap') is not None:
+            watch.status = 'watching'
+            watch.initial_market_cap = state['initialMarketCap']
+            watch.current_market_cap = state.get('currentMarketCap')
+            watch.source = state.get('source')
+            watch.polls = state.get('polls', 0)
+            watch.deadline = time.monotonic() + (state.get('secondsLeft') or 0)
+        return watch
+
+
+class WatchScheduler:
+    # Every watched contract lives in one heap keyed by its next poll time,
+    # and a single task on the runtime loop pops whatever is due. Polls run
+    # as tasks bounded by a semaphore, so thousands of watches share one
+    # loop without a thread or an event loop each.
+    #
+    # fetch(contract_key) -> (market_cap, source) is awaited for each poll.
+    # It may raise RetryLater to put the poll off instead of failing it. A
+    # watch still waiting for its first quote is put off for at most
+    # max_defer seconds, then given up on as 'unavailable'; one already
+    # watching is bounded by its own deadline.
+    # on_alert(watch) is called when the first quote arrives and again if
+    # the market cap drops past the watch's threshold. It is called
+    # synchronously, so it can record the alert before anything else runs,
+    # and returns an awaitable for the send, which runs as its own task so a
+    # slow Telegram send never holds a poll slot.
+    # on_done(watch) is called once a watch leaves the scheduler.
+    #
+    # Admission: at most max_watches are held at once. When full, a new watch
+    # replaces the lowest-priority one if it outranks it (status 'shed'),
+    # otherwise add() raises SchedulerFull. Priority is the rank of the
+    # watch's channel in priority_channels (earlier is higher, unlisted is
+    # lowest), then, if shed_oldest is set, how recently it was called.
+
+    def __init__(self, fetch, on_alert, on_done=None, max_concurrency=50, poll_intervals=None,
+                 max_watches=5000, priority_channels=(), shed_oldest=True, max_defer=DEFAULT_MAX_DEFER):
+        self.fetch = fetch
+        self.on_alert = on_alert
+        self.on_done = on_done
+        self.max_concurrency = max_concurrency
+        self.max_defer = max_defer
+        self.poll_intervals = poll_intervals or {}
+        self.max_watches = max_watches
+        self.priority_channels = list(priority_channels)
+        self.shed_oldest = shed_oldest
+        self.draining = False
+        self.shed = 0
+        self.rejected = 0
+        self.watches = {}
+        self._heap = []
+        self._victims = []  # (priority, seq, watch), lowest priority first
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._slots = None
+        self._runner = None
+        self._polling = set()
+        self._alerting = set()
+
+    def start(self):
+        if self._runner is None:
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        for task in list(self._polling):
+            task.cancel()
+
+    def add(self, watch):
+        # Returns False if the contract is already being watched, raises
+        # SchedulerFull if it can't be admitted.
+        self.start()
+        if watch.contract_key in self.watches:
+            return False
+        if self.draining:
+            self.rejected += 1
+            raise SchedulerFull('shutting down')
+        if len(self.watches) >= self.max_watches:
+            victim = self._lowest()
+            if self.priority(victim) >= self.priority(watch):
+                self.rejected += 1
+                raise SchedulerFull(f"{len(self.watches)} watches in progress")
+            metrics.trace('watch.shed', victim.contract_key, victim.trace_id, admitting=watch.contract_key)
+            self.shed += 1
+            self._finish(victim, 'shed')
+        self.watches[watch.contract_key] = watch
+        heapq.heappush(self._victims, (self.priority(watch), next(self._seq), watch))
+        watch.next_poll = time.monotonic()
+        self._push(watch)
+        return True
+
+    def cancel(self, contract_key):
+        # Cancelled watches are dropped from the heap lazily when they come due.
+        watch = self.watches.get(contract_key)
+        if watch is None:
+            return None
+        self._finish(watch, 'cancelled')
+        return watch
+
+    def priority(self, watch):
+        try:
+            rank = len(self.priority_channels) - self.priority_channels.index(watch.channel)
+        except ValueError:
+            rank = 0
+        return (rank, watch.created_at if self.shed_oldest else 0)
+
+    async def drain(self, timeout):
+        # Stop admitting new watches and give the ones in progress up to
+        # timeout seconds to finish. Returns whatever is still unfinished.
+        self.draining = True
+        deadline = time.monotonic() + timeout
+        while (self.watches or self._alerting) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        leftover = list(self.watches.values())
+        await self.stop()
+        return leftover
+
+    def get(self, contract_key):
+        return self.watches.get(contract_key)
+
+    def snapshot(self):
+        return [watch.to_dict() for watch in self.watches.values()]
+
+    def stats(self):
+        return {
+            'watches': len(self.watches),
+            'scheduled': len(self._heap),
+            'polling': len(self._polling),
+            'alerting': len(self._alerting),
+            'shed': self.shed,
+            'rejected': self.rejected,
+        }
+
+    def _lowest(self):
+        # Lowest-priority watch still held. Finished watches are dropped from
+        # the victim heap lazily, like the poll heap; rebuild it when they
+        # make up most of it.
+        if len(self._victims) > 2 * len(self.watches) + 64:
+            self._victims = [entry for entry in self._victims if self.watches.get(entry[2].contract_key) is entry[2]]
+            heapq.heapify(self._victims)
+        while self.watches.get(self._victims[0][2].contract_key) is not self._victims[0][2]:
+            heapq.heappop(self._victims)
+        return self._victims[0][2]
+
+    def _push(self, watch):
+        heapq.heappush(self._heap, (watch.next_poll, next(self._seq), watch))
+        self._wakeup.set()
+
+    def _alert(self, watch):
+        task = asyncio.ensure_future(self.on_alert(watch))
+        self._alerting.add(task)
+        task.add_done_callback(self._alert_done)
+
+    def _alert_done(self, task):
+        self._alerting.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error sending alert: {task.exception()}")
+
+    def _finish(self, watch, status):
+        watch.status = status
+        if self.watches.get(watch.contract_key) is watch:
+            del self.watches[watch.contract_key]
+            metrics.WATCH_OUTCOMES.inc(status)
+            metrics.trace('watch.done', watch.contract_key, watch.trace_id, status=status, polls=watch.polls,
+                          seconds=round(time.time() - watch.created_at, 3))
+            if self.on_done is not None:
+                self.on_done(watch)
+
+    def _defer(self, watch, retry):
+        # Put the poll off by retry.delay, but not past the watch's deadline,
+        # or for a pending watch, past max_defer seconds of being put off.
+        now = time.monotonic()
+        if watch.status == 'pending':
+            if watch.deferred_since is None:
+                watch.deferred_since = now
+            give_up_at = watch.deferred_since + self.max_defer
+            if now >= give_up_at:
+                metrics.trace('watch.error', watch.contract_key, watch.trace_id, error=str(retry))
+                self._finish(watch, 'unavailable')
+                return
+        else:
+            give_up_at = watch.deadline
+        metrics.trace('watch.deferred', watch.contract_key, watch.trace_id, delay=round(retry.delay, 3), reason=str(retry))
+        watch.next_poll = min(now + retry.delay, give_up_at)
+        self._push(watch)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            next_poll, _, watch = self._heap[0]
+            delay = next_poll - time.monotonic()
+            if delay > 0:
+                # Sleep until the earliest poll, or until add() pushes
+                # something earlier.
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            if self.watches.get(watch.contract_key) is not watch:
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._poll(watch))
+            self._polling.add(task)
+            task.add_done_callback(self._polling.discard)
+
+    async def _poll(self, watch):
+        try:
+            await self._step(watch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.trace('watch.error', watch.contract_key, watch.trace_id, error=str(e))
+            self._finish(watch, 'error')
+        finally:
+            self._slots.release()
+
+    async def _step(self, watch):
+        if watch.status == 'watching' and time.monotonic() > watch.deadline:
+            self._finish(watch, 'timed_out')
+            return
+
+        started = time.perf_counter()
+        try:
+            market_cap, source = await self.fetch(watch.contract_key)
+        except RetryLater as e:
+            if self.watches.get(watch.contract_key) is watch:
+                self._defer(watch, e)
+            return
+        if self.watches.get(watch.contract_key) is not watch:
+            return  # cancelled while the quote was in flight
+        watch.polls += 1
+        metrics.trace('watch.poll', watch.contract_key, watch.trace_id, marketCap=market_cap, source=source,
+                      ms=round((time.perf_counter() - started) * 1000, 2))
+
+        if market_cap is None:
+            self._finish(watch, 'failed' if watch.status == 'pending' else 'error')
+            return
+
+        watch.current_market_cap = market_cap
+        watch.source = source
+        watch.poll_interval = self.poll_intervals.get(source, watch.poll_interval)
+
+        if watch.status == 'pending':
+            watch.initial_market_cap = market_cap
+            self._alert(watch)
+            watch.status = 'watching'
+            watch.deadline = time.monotonic() + watch.timeout
+        elif market_cap <= watch.initial_market_cap * watch.drop_threshold:
+            self._alert(watch)
+            self._finish(watch, 'dropped')
+            return
+
+        watch.next_poll = time.monotonic() + watch.poll_interval
+        self._push(watch)